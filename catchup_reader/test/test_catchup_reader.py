@@ -1,12 +1,15 @@
+from array import array
 import builtins
-from collections import deque
 import io
+import os
 import sys
 import pytest
 import random
 import subprocess
+import threading
 from typing import Any, Protocol, runtime_checkable
 
+from catchup_reader.src import catchup_reader as catchup_reader_module
 from catchup_reader.src.catchup_reader import CatchUpReader, SeekableStream, ReadableStream
 
 def test_catchup_reader_init():
@@ -19,7 +22,9 @@ def test_catchup_reader_init():
     assert reader.num_lines_delimited == 0
     assert reader.num_lines_returned == 0
     assert isinstance(reader._queued_bytes, bytearray)
-    assert isinstance(reader._delimited_bytes, deque)
+    assert isinstance(reader._segments, bytearray)
+    assert isinstance(reader._forced_line_ends, array)
+    assert reader._num_lines_decoded == 0
 
 def test_catchup_reader_set_seekable():
     reader = CatchUpReader(seekable=True, keepends=True)
@@ -129,6 +134,114 @@ def test_catchup_reader_len_64k_100_newline_xa_not_last():
         total_chars += line.count("X")
     assert total_chars == STREAM_LEN - NEWLINE_COUNT
 
+def test_catchup_reader_len_1m_lines_read_in_chunks():
+    LINE_COUNT = 16384
+    data = b"X" * 63 + b"\n"
+    reader = CatchUpReader(seekable=True, keepends=True)
+    with io.BytesIO(data * LINE_COUNT + b"Y") as f:
+        reader.read(f)
+        assert reader.num_bytes_read == len(data) * LINE_COUNT + 1
+        assert reader.num_lines_delimited == LINE_COUNT
+    assert len(reader._queued_bytes) == 1
+    assert all(line == data.decode() for line in reader.readlines())
+
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        (b"", -1),
+        (b"XYZ", -1),
+        (b"X\n", 1),
+        (b"X\r", 1),
+        (b"X\nY\rZ", 3),
+        (b"X\rY\nZ", 3),
+        (b"X\r\nZ", 2),
+        (b"X\n\rZ", 2),
+    ],
+)
+def test_catchup_reader_scan_last_newline(data: bytes, expected: int):
+    reader = CatchUpReader(seekable=True, keepends=True)
+    assert reader._scan_last_newline(data) == expected
+
+def test_catchup_reader_count_line_ends_matches_splitlines():
+    random_src = random.Random(20240825)
+    reader = CatchUpReader(seekable=True, keepends=True)
+    for _ in range(1000):
+        data = bytes(random_src.choice(b"XX\r\n") for _ in range(random_src.randint(0, 20)))
+        end = random_src.randint(0, len(data))
+        expected = sum(1 for line in data[:end].splitlines(keepends=True) if line.endswith((b"\r", b"\n")))
+        assert reader._count_line_ends(data, end) == expected
+        assert reader._count_line_ends(data[:end]) == expected
+
+def test_catchup_reader_readline_decodes_in_batches():
+    reader = CatchUpReader(seekable=False, keepends=False)
+    reader.read(b"A\nB\x0cC\r\nD\r")
+    reader.read(b"E\n")
+    assert reader.readline() == "A"
+    reader.set_keepends(True)
+    assert reader.readline() == "B\x0cC\r\n"
+    assert list(reader.readlines()) == ["D\r", "E\n"]
+    assert reader.num_lines_returned == reader.num_lines_delimited == 4
+
+def test_catchup_reader_readline_split_crlf_and_form_feed():
+    reader = CatchUpReader(seekable=False, keepends=True)
+    reader.read(b"A\r")
+    reader.read(b"\nB\x0cC\n")
+    assert list(reader.readlines()) == ["A\r", "\n", "B\x0cC\n"]
+
+def test_catchup_reader_readline_unterminated_line_before_form_feed():
+    reader = CatchUpReader(seekable=False, keepends=True)
+    reader.set_writer_as_stopped()
+    reader.read(b"A")
+    reader.read(b"B\x0cC\n")
+    assert list(reader.readlines()) == ["A", "B\x0cC\n"]
+
+def test_catchup_reader_readline_skips_undecodable_line():
+    reader = CatchUpReader(seekable=False, keepends=False)
+    reader.read(b"good1\n\xff\ngood2\n")
+    assert reader.readline() == "good1"
+    with pytest.raises(UnicodeDecodeError):
+        reader.readline()
+    assert reader.readline() == "good2"
+    assert reader.readline() is None
+    assert reader.num_lines_returned == 2
+    reader.read(b"\xfe\ngood3\n")
+    with pytest.raises(UnicodeDecodeError):
+        list(reader.readlines())
+    assert list(reader.readlines()) == ["good3"]
+
+def test_catchup_reader_readlines_includes_lines_delimited_while_iterating():
+    reader = CatchUpReader(seekable=False, keepends=False)
+    reader.read(b"A\nB\n")
+    actual_lines = list[str]()
+    for line in reader.readlines():
+        actual_lines.append(line)
+        if line == "B":
+            reader.read(b"C\n")
+    assert actual_lines == ["A", "B", "C"]
+    assert reader.num_lines_returned == reader.num_lines_delimited == 3
+
+def test_catchup_reader_readlines_stopped_early_keeps_remaining_lines():
+    reader = CatchUpReader(seekable=False, keepends=False)
+    reader.read(b"A\nB\nC\n")
+    for line in reader:
+        assert line == "A"
+        break
+    assert reader.num_lines_returned == 1
+    assert reader.readline() == "B"
+    assert list(reader.readlines()) == ["C"]
+
+def test_catchup_reader_segments_compacted_after_partial_drain():
+    reader = CatchUpReader(seekable=False, keepends=False)
+    reader.read(b"A\nBB\nCCC\nDDDD\n")
+    assert [reader.readline() for _ in range(3)] == ["A", "BB", "CCC"]
+    reader.read(b"EEEEE\n")
+    assert bytes(reader._segments) == b"A\nBB\nCCC\nDDDD\nEEEEE\n"
+    assert reader.readline() == "DDDD"
+    assert reader.readline() == "EEEEE"
+    assert bytes(reader._segments) == b"EEEEE\n"
+    assert reader.readline() is None
+    assert len(reader._segments) == 0
+
 @pytest.mark.parametrize(
     "newline_delimiter,keepends",
     [
@@ -197,6 +310,93 @@ def test_catchup_reader_random_chop_multibyte_newlines(newline_delimiter: bytes,
     assert len(actual_text) == LINE_COUNT
 
 
+def test_catchup_reader_read_from_regular_file(tmp_path):
+    path = tmp_path / "catchup.txt"
+    reader = CatchUpReader(seekable=True, keepends=False)
+    with open(path, "wb") as writer:
+        writer.write(b"X\nY")
+        writer.flush()
+        with open(path, "rb") as f:
+            reader.read(f)
+            assert reader.num_bytes_read == 3
+            assert reader.num_bytes_delimited == 2
+            writer.write(b"Y\nZ")
+            writer.flush()
+            reader.read(f)
+            assert reader.num_bytes_read == 6
+            assert reader.num_bytes_delimited == 5
+            reader.set_writer_as_stopped()
+            reader.read(f)
+    assert reader.num_bytes_delimited == 6
+    assert list(reader.readlines()) == ["X", "YY", "Z"]
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32" and sys.version_info < (3, 12),
+    reason="os.set_blocking() does not support pipes on Windows before Python 3.12",
+)
+@pytest.mark.parametrize("has_readv", [hasattr(os, "readv"), False])
+def test_catchup_reader_read_fd_from_nonblocking_pipe(has_readv: bool, monkeypatch):
+    monkeypatch.setattr(catchup_reader_module, "_HAS_READV", has_readv)
+    read_fd, write_fd = os.pipe()
+    try:
+        os.set_blocking(read_fd, False)
+        reader = CatchUpReader(seekable=True, keepends=False)
+        reader.read_fd(read_fd)
+        assert reader.num_bytes_read == 0
+        assert not reader.seekable
+        os.write(write_fd, b"X\nY")
+        reader.read_fd(read_fd)
+        assert reader.num_bytes_read == 3
+        assert reader.num_bytes_delimited == 2
+        os.write(write_fd, b"Y" * 60000 + b"\nZ")
+        reader.read_fd(read_fd)
+        assert reader.num_bytes_read == 60005
+        os.close(write_fd)
+        write_fd = -1
+        reader.set_writer_as_stopped()
+        reader.read_fd(read_fd)
+    finally:
+        os.close(read_fd)
+        if write_fd >= 0:
+            os.close(write_fd)
+    assert reader.num_bytes_delimited == 60005
+    assert list(reader.readlines()) == ["X", "Y" * 60001, "Z"]
+
+
+def test_catchup_reader_read_and_readline_from_separate_threads():
+    LINE_COUNT = 10000
+    reader = CatchUpReader(seekable=False, keepends=False)
+    def produce():
+        for line_idx in range(LINE_COUNT):
+            reader.read(f"{line_idx}\n".encode())
+    producer = threading.Thread(target=produce)
+    producer.start()
+    actual_lines = list[str]()
+    while producer.is_alive() or reader.num_lines_returned < reader.num_lines_delimited:
+        actual_lines.extend(reader.readlines())
+    producer.join()
+    actual_lines.extend(reader.readlines())
+    assert actual_lines == [str(line_idx) for line_idx in range(LINE_COUNT)]
+
+
+def test_catchup_reader_read_from_bytes_subclass():
+    class BytesSubclass(bytes):
+        pass
+    reader = CatchUpReader(seekable=True, keepends=True)
+    reader.read(BytesSubclass(b"X\nY"))
+    assert reader.num_bytes_read == 3
+    assert reader.num_bytes_delimited == 2
+
+
+def test_catchup_reader_read_rejects_non_stream():
+    reader = CatchUpReader(seekable=True, keepends=True)
+    with pytest.raises(TypeError):
+        reader.read("X\n")
+    with pytest.raises(TypeError):
+        reader.read(12345)
+
+
 @runtime_checkable
 class MockStreamProtocol(ReadableStream, SeekableStream, Protocol):
     pass
@@ -240,6 +440,26 @@ class MockStreamSpy(MockStreamProtocol):
         self._call_history.append(call_result)
         return call_result[2]
 
+def test_catchup_reader_caches_stream_queries():
+    reader = CatchUpReader(seekable=True, keepends=True)
+    history = list[tuple[str, Any, Any]]()
+    with io.BytesIO(b"X\nY") as stream:
+        spy = MockStreamSpy(stream, history)
+        reader.read(spy)
+        reader.read(spy)
+    names = [name for name, _, _ in history]
+    assert names.count("readable") == 1
+    assert names.count("seekable") == 1
+    assert names.count("read") == 2
+    history.clear()
+    with io.BytesIO(b"X\nYZ") as stream:
+        spy = MockStreamSpy(stream, history)
+        reader.read(spy)
+    names = [name for name, _, _ in history]
+    assert names.count("readable") == 1
+    assert names.count("seekable") == 1
+    assert reader.num_bytes_read == 4
+
 def test_catchup_reader_noseek_since_init():
     LEN_X = 100
     LEN_Y = 100